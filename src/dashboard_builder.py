@@ -4,12 +4,35 @@ Dashboard-as-code for time-series data and monitoring
 """
 import sqlite3
 import json
-from dataclasses import dataclass, field, asdict
+import threading
+import atexit
+import weakref
+from functools import partial
+from array import array
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
-from typing import List, Dict, Optional, Tuple
+from typing import List, Dict, Iterator, Optional, Tuple
 from enum import Enum
 from pathlib import Path
-import statistics
+from hashlib import blake2b
+import random
+import time
+import asyncio
+import logging
+import math
+
+try:
+    import numpy as np
+except ImportError:  # optional: vectorized statistics
+    np = None
+
+try:
+    import orjson
+except ImportError:  # optional: faster JSON (de)serialization
+    orjson = None
+
+logger = logging.getLogger(__name__)
 
 
 class PanelType(Enum):
@@ -28,7 +51,7 @@ class VariableType(Enum):
     INTERVAL = "interval"
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Position:
     """Panel position and size on dashboard grid"""
     x: int = 0
@@ -37,7 +60,7 @@ class Position:
     h: int = 8
 
 
-@dataclass
+@dataclass(slots=True)
 class Panel:
     """Represents a visualization panel"""
     id: str
@@ -47,9 +70,11 @@ class Panel:
     query: str = ""
     options: Dict = field(default_factory=dict)
     position: Position = field(default_factory=Position)
+    # Imported keys this model has no field for (e.g. Grafana targets, fieldConfig)
+    extra: Dict = field(default_factory=dict)
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Variable:
     """Template variable for dashboard"""
     name: str
@@ -58,7 +83,7 @@ class Variable:
     current_value: str = ""
 
 
-@dataclass
+@dataclass(slots=True)
 class Dashboard:
     """Represents a monitoring dashboard"""
     id: str
@@ -73,79 +98,568 @@ class Dashboard:
     created_at: datetime = field(default_factory=datetime.now)
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Metric:
     """Time-series metric data point"""
     name: str
-    labels: Dict[str, str] = field(default_factory=dict)
+    # Left out of __hash__ (a dict is unhashable) but still compared by __eq__
+    labels: Dict[str, str] = field(default_factory=dict, hash=False)
     value: float = 0.0
     timestamp: datetime = field(default_factory=datetime.now)
 
 
+if orjson is not None:
+    def _dumps(obj, indent: bool = False, sort_keys: bool = False) -> str:
+        """Serialize to a compact (or 2-space indented) JSON string"""
+        option = orjson.OPT_INDENT_2 if indent else 0
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, option=option).decode()
+
+    _loads = orjson.loads
+else:
+    def _dumps(obj, indent: bool = False, sort_keys: bool = False) -> str:
+        """Serialize to a compact (or 2-space indented) JSON string"""
+        if indent:
+            return json.dumps(obj, indent=2, sort_keys=sort_keys, ensure_ascii=False)
+        return json.dumps(obj, sort_keys=sort_keys, separators=(",", ":"),
+                          ensure_ascii=False)
+
+    _loads = json.loads
+
+
+# Bumped whenever _init_db gains a table, index or migration
+SCHEMA_VERSION = 3
+
+# Pre-serialized empty containers, skipping an encoder call on common paths
+_EMPTY_JSON_ARRAY = "[]"
+_EMPTY_JSON_OBJ = "{}"
+
+# Statements reused on every call; sqlite3 caches the compiled form per
+# connection keyed by SQL text, so hot paths skip re-parsing
+SQL_INS_DASH = """
+    INSERT INTO dashboards VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+SQL_REPLACE_DASH = """
+    INSERT OR REPLACE INTO dashboards VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+SQL_SEL_DASH = """
+    SELECT id, uid, title, description, tags, refresh_interval, time_range, created_at
+    FROM dashboards WHERE id = ?
+"""
+SQL_SEL_DASH_IDS = "SELECT id FROM dashboards WHERE id = ? OR uid = ?"
+SQL_INS_PANEL = """
+    INSERT INTO panels (dashboard_id, id, title, type, datasource, query, options,
+                        pos_x, pos_y, w, h, extra)
+    SELECT ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?
+    WHERE EXISTS (SELECT 1 FROM dashboards WHERE id = ?)
+"""
+SQL_SEL_PANELS = """
+    SELECT id, title, type, datasource, query, options, pos_x, pos_y, w, h, extra
+    FROM panels WHERE dashboard_id = ? ORDER BY rowid
+"""
+SQL_DEL_PANELS = "DELETE FROM panels WHERE dashboard_id = ?"
+SQL_INS_VARIABLE = """
+    INSERT INTO variables (dashboard_id, name, type, query, current_value)
+    SELECT ?, ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM dashboards WHERE id = ?)
+"""
+SQL_SEL_VARIABLES = """
+    SELECT name, type, query, current_value
+    FROM variables WHERE dashboard_id = ? ORDER BY rowid
+"""
+SQL_DEL_VARIABLES = "DELETE FROM variables WHERE dashboard_id = ?"
+SQL_INS_METRIC = """
+    INSERT OR IGNORE INTO metrics (name, labels, value, timestamp)
+    VALUES (?, ?, ?, ?)
+"""
+SQL_MAX_METRIC_ID = "SELECT COALESCE(MAX(id), 0) FROM metrics"
+SQL_SEL_METRICS_SINCE = "SELECT name, labels, value FROM metrics WHERE id > ?"
+SQL_SEL_METRICS_RANGE = """
+    SELECT timestamp, value FROM metrics
+    WHERE name = ? AND labels = ? AND timestamp BETWEEN ? AND ?
+    ORDER BY timestamp ASC
+"""
+SQL_SEL_METRICS_ALL = """
+    SELECT timestamp, value FROM metrics WHERE name = ? AND labels = ?
+    ORDER BY timestamp ASC
+"""
+SQL_SEL_BUCKETS_RANGE = """
+    SELECT (timestamp / ?) * ?, AVG(value) FROM metrics
+    WHERE name = ? AND labels = ? AND timestamp BETWEEN ? AND ?
+    GROUP BY timestamp / ? ORDER BY 1
+"""
+SQL_SEL_BUCKETS_ALL = """
+    SELECT (timestamp / ?) * ?, AVG(value) FROM metrics
+    WHERE name = ? AND labels = ?
+    GROUP BY timestamp / ? ORDER BY 1
+"""
+SQL_SEL_CURRENT = """
+    SELECT timestamp, value FROM metrics
+    WHERE name = ? AND labels = ?
+    ORDER BY timestamp DESC LIMIT 1
+"""
+SQL_AGG_SERIES = """
+    SELECT MIN(value), MAX(value), AVG(value), COUNT(value)
+    FROM metrics WHERE name = ? AND labels = ?
+"""
+SQL_AGG_SERIES_FROM = """
+    SELECT MIN(value), MAX(value), AVG(value), COUNT(value) FROM metrics
+    WHERE name = ? AND labels = ? AND timestamp >= ?
+"""
+SQL_P95_SERIES_FROM = """
+    SELECT value FROM metrics
+    WHERE name = ? AND labels = ? AND timestamp >= ? AND value IS NOT NULL
+    ORDER BY value LIMIT 1 OFFSET ?
+"""
+SQL_SAMPLE_SERIES = """
+    SELECT value FROM metrics WHERE name = ? AND labels = ? AND value IS NOT NULL
+    ORDER BY random() LIMIT ?
+"""
+SQL_DEL_STATS = "DELETE FROM metric_stats WHERE name = ? AND labels = ?"
+SQL_SEL_STATS = """
+    SELECT min_value, max_value, avg_value, reservoir, count
+    FROM metric_stats WHERE name = ? AND labels = ?
+"""
+SQL_SEL_STATS_STATE = """
+    SELECT min_value, max_value, avg_value, count, reservoir
+    FROM metric_stats WHERE name = ? AND labels = ?
+"""
+SQL_UPSERT_STATS = """
+    INSERT OR REPLACE INTO metric_stats
+    (name, labels, min_value, max_value, avg_value, count, reservoir, last_updated)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+# Rows fetched per round trip when streaming a series
+_FETCH_CHUNK = 8192
+
+# Consecutive transient flush failures before a buffered batch is dropped
+_MAX_FLUSH_ATTEMPTS = 3
+
+# Seconds a cached current value is served without rereading SQLite
+_CURRENT_TTL = 60.0
+
+# Series whose current value is cached; least recently used are evicted
+_CURRENT_MAX = 10_000
+
+# Values sampled per series to estimate p95 without scanning the series
+_RESERVOIR_SIZE = 1024
+
+
+def _to_us(ts: datetime) -> int:
+    """Convert a datetime to integer microseconds since the epoch"""
+    return int(ts.replace(microsecond=0).timestamp()) * 1_000_000 + ts.microsecond
+
+
+def _from_us(us: int) -> datetime:
+    """Convert integer microseconds since the epoch back to a local datetime"""
+    return datetime.fromtimestamp(us // 1_000_000).replace(microsecond=us % 1_000_000)
+
+
+def _to_value(value) -> float:
+    """Convert a metric value to float, rejecting NaN and infinities
+
+    SQLite stores NaN as NULL, which would poison the running stats.
+    """
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError(f"metric value must be finite, got {value!r}")
+    return value
+
+
+def _legacy_ts_to_us(ts) -> int:
+    """Convert a legacy timestamp column value (ISO-8601 or microseconds) to microseconds"""
+    return _to_us(datetime.fromisoformat(ts)) if isinstance(ts, str) else ts
+
+
+# Panel keys stored in their own columns; any other key goes to panels.extra
+_PANEL_TEXT_KEYS = ("id", "title", "type", "datasource", "query")
+_PANEL_KEYS = frozenset(_PANEL_TEXT_KEYS + ("options", "position"))
+
+
+def _as_text(value) -> str:
+    """Return strings as-is and serialize anything else to JSON"""
+    return value if isinstance(value, str) else _dumps(value)
+
+
+def _panel_from_dict(data: Dict) -> Panel:
+    """Build a Panel from its exported dict form or a Grafana panel
+
+    Unmodelled keys and non-string values of text fields (Grafana's
+    datasource object, integer ids) are kept verbatim in Panel.extra so
+    that export_json returns them unchanged.
+    """
+    pos = data.get("position") or data.get("gridPos") or {}
+    extra = {k: v for k, v in data.items() if k not in _PANEL_KEYS}
+    extra.update((k, data[k]) for k in _PANEL_TEXT_KEYS
+                 if k in data and not isinstance(data[k], str))
+    return Panel(
+        id=_as_text(data.get("id", "")),
+        title=_as_text(data.get("title", "")),
+        type=_as_text(data.get("type", "")),
+        datasource=_as_text(data.get("datasource", "prometheus")),
+        query=_as_text(data.get("query", "")),
+        options=data.get("options", {}),
+        position=Position(x=pos.get("x", 0), y=pos.get("y", 0),
+                          w=pos.get("w", 12), h=pos.get("h", 8)),
+        extra=extra
+    )
+
+
+def _panel_row(dashboard_id: str, panel: Panel) -> Tuple:
+    """Flatten a Panel into SQL_INS_PANEL parameters"""
+    pos = panel.position
+    options_json = _dumps(panel.options) if panel.options else _EMPTY_JSON_OBJ
+    extra_json = _dumps(panel.extra) if panel.extra else None
+    return (dashboard_id, panel.id, panel.title, panel.type, panel.datasource, panel.query,
+            options_json, pos.x, pos.y, pos.w, pos.h, extra_json, dashboard_id)
+
+
+def _canon_labels(labels: Optional[Dict[str, str]]) -> str:
+    """Serialize labels to a canonical key-sorted, compact JSON string"""
+    if not labels:
+        return _EMPTY_JSON_OBJ
+    # Always the stdlib encoder: the stored key must not depend on whether
+    # orjson is installed, which differs on escaping, floats and key types
+    return json.dumps({str(k): v for k, v in labels.items()}, sort_keys=True,
+                      separators=(",", ":"), ensure_ascii=False)
+
+
+def _unpack_reservoir(data) -> array:
+    """Decode a stored reservoir: packed float64 BLOB, or JSON text from older files"""
+    reservoir = array("d")
+    if isinstance(data, bytes):
+        reservoir.frombytes(data)
+    elif data:
+        reservoir.extend(_loads(data))
+    return reservoir
+
+
+def _p95(values) -> float:
+    """95th percentile by rank, i.e. sorted(values)[int(n * 0.95)]"""
+    k = min(int(len(values) * 0.95), len(values) - 1)
+    if np is not None:
+        # Selection is O(n); only the k-th element needs to land in place
+        return float(np.partition(np.asarray(values, dtype=np.float64), k)[k])
+    return sorted(values)[k]
+
+
 class DashboardBuilder:
     """Grafana-inspired dashboard builder and metrics system"""
 
-    def __init__(self, db_path: Optional[str] = None):
+    def __init__(self, db_path: Optional[str] = None, flush_size: int = 500,
+                 flush_interval: float = 1.0):
         if db_path == ":memory:":
             self.db_path = ":memory:"
         else:
             self.db_path = db_path or str(Path.home() / ".blackroad" / "dashboards.db")
             Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.executescript("""
+            PRAGMA busy_timeout=5000;
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            PRAGMA temp_store=MEMORY;
+            PRAGMA cache_size=-20000;
+        """)
         self._init_db()
 
+        self._buf = deque()
+        self._current: OrderedDict[Tuple[str, str], Tuple[int, float, float]] = OrderedDict()
+        # Series with points still in _buf; their cache entries are not trusted
+        self._dirty: set = set()
+        self._buf_lock = threading.Lock()
+        # Held from draining the buffer until its rows are committed, so a
+        # reader's flush() waits for any flush already in progress
+        self._flush_lock = threading.Lock()
+        self._flush_size = flush_size
+        self._flush_failures = 0
+        self._wake = threading.Event()
+        self._closed = threading.Event()
+        # The thread and the atexit hook only hold weak references, so an
+        # unclosed builder can still be garbage-collected (see __del__)
+        ref = weakref.ref(self)
+        self._flusher_thread = threading.Thread(
+            target=_flusher_loop, args=(ref, self._wake, self._closed, flush_interval),
+            daemon=True)
+        self._flusher_thread.start()
+        self._atexit_hook = partial(_close_if_alive, ref)
+        atexit.register(self._atexit_hook)
+
+    def close(self):
+        """Flush buffered metrics and close the database connection"""
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._wake.set()
+        if threading.current_thread() is not self._flusher_thread:
+            self._flusher_thread.join()
+        atexit.unregister(self._atexit_hook)
+        try:
+            self.flush()
+        finally:
+            with self._lock:
+                self._conn.close()
+            if self._buf:
+                logger.error("Closed with %d buffered metric points unwritten",
+                             len(self._buf))
+
+    def __del__(self):
+        if getattr(self, "_atexit_hook", None) is not None:
+            self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
     def _init_db(self):
-        """Initialize SQLite database schema"""
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
+        """Initialize SQLite database schema, migrating older layouts in place"""
+        with self._lock:
+            c = self._conn.cursor()
+            c.execute("PRAGMA user_version")
+            if c.fetchone()[0] >= SCHEMA_VERSION:
+                return
 
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS dashboards (
-                id TEXT PRIMARY KEY,
-                uid TEXT UNIQUE,
-                title TEXT NOT NULL,
-                description TEXT,
-                tags TEXT,
-                panels TEXT,
-                variables TEXT,
-                refresh_interval TEXT DEFAULT '30s',
-                time_range TEXT DEFAULT '1h',
-                created_at TEXT
-            )
-        """)
+            # IMMEDIATE so concurrent first opens queue on busy_timeout instead of
+            # failing to upgrade a read lock; whoever goes second sees the new version
+            c.execute("BEGIN IMMEDIATE")
+            c.execute("PRAGMA user_version")
+            if c.fetchone()[0] >= SCHEMA_VERSION:
+                c.execute("COMMIT")
+                return
+
+            c.execute("PRAGMA table_info(dashboards)")
+            legacy_dashboards = "panels" in {col[1] for col in c.fetchall()}
+            if legacy_dashboards:
+                c.execute("ALTER TABLE dashboards RENAME TO dashboards_legacy")
+
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS dashboards (
+                    id TEXT PRIMARY KEY,
+                    uid TEXT UNIQUE,
+                    title TEXT NOT NULL,
+                    description TEXT,
+                    tags TEXT,
+                    refresh_interval TEXT DEFAULT '30s',
+                    time_range TEXT DEFAULT '1h',
+                    created_at TEXT
+                )
+            """)
+
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS panels (
+                    dashboard_id TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    title TEXT,
+                    type TEXT,
+                    datasource TEXT,
+                    query TEXT,
+                    options TEXT,
+                    pos_x INTEGER,
+                    pos_y INTEGER,
+                    w INTEGER,
+                    h INTEGER,
+                    extra TEXT
+                )
+            """)
+            c.execute("PRAGMA table_info(panels)")
+            if "extra" not in {col[1] for col in c.fetchall()}:
+                c.execute("ALTER TABLE panels ADD COLUMN extra TEXT")
+            c.execute("CREATE INDEX IF NOT EXISTS idx_panels_dashboard ON panels(dashboard_id)")
+
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS variables (
+                    dashboard_id TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    type TEXT,
+                    query TEXT,
+                    current_value TEXT
+                )
+            """)
+            c.execute("CREATE INDEX IF NOT EXISTS idx_variables_dashboard ON variables(dashboard_id)")
+
+            if legacy_dashboards:
+                self._migrate_legacy_dashboards(c)
+
+            c.execute("PRAGMA table_info(metrics)")
+            columns = {col[1]: col[2] for col in c.fetchall()}
+            legacy_metrics = bool(columns) and (columns["timestamp"].upper() != "INTEGER"
+                                                or "created_at" in columns)
+            if legacy_metrics:
+                c.execute("DROP INDEX IF EXISTS idx_metrics_name_labels_ts")
+                c.execute("ALTER TABLE metrics RENAME TO metrics_legacy")
+
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS metrics (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT NOT NULL,
+                    labels TEXT,
+                    value REAL,
+                    timestamp INTEGER NOT NULL,
+                    UNIQUE(name, labels, timestamp)
+                )
+            """)
+            if legacy_metrics:
+                self._migrate_legacy_metrics(c)
 
+            c.execute("""
+                CREATE INDEX IF NOT EXISTS idx_metrics_name_labels_ts
+                ON metrics(name, labels, timestamp, value)
+            """)
+
+            c.execute("PRAGMA table_info(metric_stats)")
+            columns = {col[1] for col in c.fetchall()}
+            legacy_stats = bool(columns) and "labels" not in columns
+            if legacy_stats:
+                # The old per-name table was never populated, so just replace it
+                c.execute("DROP TABLE metric_stats")
+
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS metric_stats (
+                    name TEXT NOT NULL,
+                    labels TEXT NOT NULL,
+                    min_value REAL,
+                    max_value REAL,
+                    avg_value REAL,
+                    p95_value REAL,
+                    count INTEGER,
+                    reservoir BLOB,
+                    last_updated TEXT,
+                    PRIMARY KEY (name, labels)
+                )
+            """)
+            relabeled = self._canonicalize_labels(c)
+            if legacy_stats:
+                c.execute("SELECT DISTINCT name, labels FROM metrics")
+                self._rebuild_stats(c, c.fetchall())
+            elif relabeled:
+                self._rebuild_stats(c, relabeled)
+
+            c.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            c.execute("COMMIT")
+
+    def _migrate_legacy_dashboards(self, c: sqlite3.Cursor):
+        """Split the panels/variables JSON columns out into their own tables"""
         c.execute("""
-            CREATE TABLE IF NOT EXISTS metrics (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                labels TEXT,
-                value REAL,
-                timestamp TEXT,
-                created_at TEXT,
-                UNIQUE(name, labels, timestamp)
-            )
+            INSERT INTO dashboards
+            SELECT id, uid, title, description, tags, refresh_interval, time_range, created_at
+            FROM dashboards_legacy
         """)
+        c.execute("SELECT id, panels, variables FROM dashboards_legacy")
+        for dashboard_id, panels_json, variables_json in c.fetchall():
+            self._insert_children(c, dashboard_id, _loads(panels_json or _EMPTY_JSON_ARRAY),
+                                  _loads(variables_json or _EMPTY_JSON_ARRAY))
+        c.execute("DROP TABLE dashboards_legacy")
 
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS metric_stats (
-                name TEXT PRIMARY KEY,
-                min_value REAL,
-                max_value REAL,
-                avg_value REAL,
-                p95_value REAL,
-                count INTEGER,
-                last_updated TEXT
-            )
+    def _insert_children(self, c: sqlite3.Cursor, dashboard_id: str,
+                         panels: List[Dict], variables: List[Dict]):
+        """Insert panel and variable dicts (as exported) for a dashboard"""
+        c.executemany(SQL_INS_PANEL, [
+            _panel_row(dashboard_id, _panel_from_dict(p)) for p in panels
+        ])
+        c.executemany(SQL_INS_VARIABLE, [
+            (dashboard_id, v.get("name", ""), v.get("type", "query"), v.get("query", ""),
+             v.get("current_value", ""), dashboard_id)
+            for v in variables
+        ])
+
+    def _migrate_legacy_metrics(self, c: sqlite3.Cursor):
+        """Copy rows from an older metrics layout into the current table"""
+        legacy = self._conn.execute("""
+            SELECT name, labels, value, timestamp FROM metrics_legacy
         """)
+        c.executemany(SQL_INS_METRIC, (
+            (name, labels, value, _legacy_ts_to_us(ts))
+            for name, labels, value, ts in legacy
+        ))
+        c.execute("DROP TABLE metrics_legacy")
 
-        conn.commit()
-        conn.close()
+    def _canonicalize_labels(self, c: sqlite3.Cursor) -> List[Tuple[str, str]]:
+        """Rewrite non-canonical stored labels; return the series that changed"""
+        relabeled = set()
+        c.execute("SELECT DISTINCT name, labels FROM metrics WHERE labels IS NOT NULL")
+        for name, labels_json in c.fetchall():
+            canon = _canon_labels(_loads(labels_json))
+            if canon != labels_json:
+                c.execute("""
+                    UPDATE OR REPLACE metrics SET labels = ? WHERE name = ? AND labels = ?
+                """, (canon, name, labels_json))
+                c.execute(SQL_DEL_STATS, (name, labels_json))
+                relabeled.add((name, canon))
+        return list(relabeled)
+
+    def _update_stats(self, c: sqlite3.Cursor, rows: List[Tuple]):
+        """Fold freshly inserted metric rows into the per-series running stats"""
+        series: Dict[Tuple[str, str], List[float]] = {}
+        for row in rows:
+            if row[2] is not None:
+                series.setdefault((row[0], row[1]), []).append(row[2])
+
+        now_iso = datetime.now().isoformat()
+        for (name, labels_json), values in series.items():
+            c.execute(SQL_SEL_STATS_STATE, (name, labels_json))
+            current = c.fetchone()
+            if current and None in current[:3]:
+                # NULL aggregates (NaN stored before values were validated):
+                # recount from the table, which already holds these rows
+                self._rebuild_stats(c, [(name, labels_json)])
+                continue
+            if current:
+                min_value, max_value, avg_value, count, reservoir_blob = current
+                reservoir = _unpack_reservoir(reservoir_blob)
+            else:
+                min_value, max_value, avg_value, count = values[0], values[0], 0.0, 0
+                reservoir = array("d")
+
+            n = len(values)
+            min_value = min(min_value, min(values))
+            max_value = max(max_value, max(values))
+            avg_value = (avg_value * count + sum(values)) / (count + n)
+            for value in values:
+                # Algorithm R: every value seen so far is kept with equal probability
+                if len(reservoir) < _RESERVOIR_SIZE:
+                    reservoir.append(value)
+                else:
+                    j = random.randrange(count + 1)
+                    if j < _RESERVOIR_SIZE:
+                        reservoir[j] = value
+                count += 1
+
+            self._write_stats(c, name, labels_json, min_value, max_value, avg_value,
+                              count, reservoir, now_iso)
+
+    def _rebuild_stats(self, c: sqlite3.Cursor, keys: List[Tuple[str, str]]):
+        """Recompute running stats for the given series from the metrics table"""
+        now_iso = datetime.now().isoformat()
+        for name, labels_json in keys:
+            c.execute(SQL_AGG_SERIES, (name, labels_json))
+            min_value, max_value, avg_value, count = c.fetchone()
+            if not count:
+                c.execute(SQL_DEL_STATS, (name, labels_json))
+                continue
+            c.execute(SQL_SAMPLE_SERIES, (name, labels_json, _RESERVOIR_SIZE))
+            reservoir = array("d", [r[0] for r in c.fetchall()])
+            self._write_stats(c, name, labels_json, min_value, max_value, avg_value,
+                              count, reservoir, now_iso)
+
+    def _write_stats(self, c: sqlite3.Cursor, name: str, labels_json: str,
+                     min_value: float, max_value: float, avg_value: float,
+                     count: int, reservoir: array, last_updated: str):
+        """Upsert one metric_stats row; p95 is derived from the reservoir on read"""
+        c.execute(SQL_UPSERT_STATS, (name, labels_json, min_value, max_value, avg_value,
+                                     count, reservoir.tobytes(), last_updated))
 
     def create_dashboard(self, title: str, description: str = "", tags: List[str] = None,
                         refresh_interval: str = "30s", time_range: str = "1h") -> Dashboard:
         """Create a new dashboard"""
-        import hashlib
-        uid = hashlib.md5(title.encode()).hexdigest()[:8]
-        dashboard_id = hashlib.md5(f"{title}{datetime.now().isoformat()}".encode()).hexdigest()[:8]
+        created_at = datetime.now()
+        uid = blake2b(title.encode(), digest_size=4).hexdigest()
+        dashboard_id = blake2b(f"{title}{created_at.isoformat()}".encode(),
+                               digest_size=4).hexdigest()
 
         dashboard = Dashboard(
             id=dashboard_id,
@@ -155,29 +669,24 @@ class DashboardBuilder:
             tags=tags or [],
             refresh_interval=refresh_interval,
             time_range=time_range,
-            created_at=datetime.now()
+            created_at=created_at
         )
 
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute("""
-            INSERT INTO dashboards VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            dashboard.id, dashboard.uid, dashboard.title, dashboard.description,
-            json.dumps(dashboard.tags), json.dumps([]), json.dumps([]),
-            dashboard.refresh_interval, dashboard.time_range,
-            dashboard.created_at.isoformat()
-        ))
-        conn.commit()
-        conn.close()
+        with self._lock:
+            c = self._conn.cursor()
+            c.execute(SQL_INS_DASH, (
+                dashboard.id, dashboard.uid, dashboard.title, dashboard.description,
+                _dumps(dashboard.tags) if dashboard.tags else _EMPTY_JSON_ARRAY,
+                dashboard.refresh_interval, dashboard.time_range,
+                dashboard.created_at.isoformat()
+            ))
         return dashboard
 
     def add_panel(self, dashboard_id: str, title: str, panel_type: str,
                  query: str, datasource: str = "prometheus",
                  position: Optional[Position] = None, options: Dict = None) -> Panel:
         """Add a panel to a dashboard"""
-        import hashlib
-        panel_id = hashlib.md5(f"{dashboard_id}/{title}".encode()).hexdigest()[:8]
+        panel_id = blake2b(f"{dashboard_id}/{title}".encode(), digest_size=4).hexdigest()
         pos = position or Position()
 
         panel = Panel(
@@ -190,18 +699,9 @@ class DashboardBuilder:
             position=pos
         )
 
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-
-        c.execute("SELECT panels FROM dashboards WHERE id = ?", (dashboard_id,))
-        result = c.fetchone()
-        if result:
-            panels = json.loads(result[0])
-            panels.append(asdict(panel))
-            c.execute("UPDATE dashboards SET panels = ? WHERE id = ?",
-                     (json.dumps(panels), dashboard_id))
-            conn.commit()
-        conn.close()
+        with self._lock:
+            c = self._conn.cursor()
+            c.execute(SQL_INS_PANEL, _panel_row(dashboard_id, panel))
         return panel
 
     def add_variable(self, dashboard_id: str, name: str, query: str,
@@ -209,99 +709,252 @@ class DashboardBuilder:
         """Add a template variable to a dashboard"""
         variable = Variable(name=name, type=var_type, query=query)
 
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-
-        c.execute("SELECT variables FROM dashboards WHERE id = ?", (dashboard_id,))
-        result = c.fetchone()
-        if result:
-            variables = json.loads(result[0])
-            variables.append(asdict(variable))
-            c.execute("UPDATE dashboards SET variables = ? WHERE id = ?",
-                     (json.dumps(variables), dashboard_id))
-            conn.commit()
-        conn.close()
+        with self._lock:
+            c = self._conn.cursor()
+            c.execute(SQL_INS_VARIABLE, (dashboard_id, variable.name, variable.type,
+                                         variable.query, variable.current_value, dashboard_id))
         return variable
 
     def push_metric(self, name: str, value: float, labels: Dict[str, str] = None) -> Metric:
         """Store a metric data point"""
+        # Convert up front so bad input fails here, not in a later flush
+        value = _to_value(value)
         metric = Metric(
             name=name,
             labels=labels or {},
             value=value,
             timestamp=datetime.now()
         )
+        row = (name, _canon_labels(labels), value, _to_us(metric.timestamp))
+        with self._buf_lock:
+            self._buf.append(row)
+            self._dirty.add((row[0], row[1]))
+            if len(self._buf) >= self._flush_size:
+                self._wake.set()
+        return metric
 
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
+    def flush(self) -> int:
+        """Write all buffered metric points to the database"""
+        with self._flush_lock:
+            with self._buf_lock:
+                rows = list(self._buf)
+                self._buf.clear()
+                self._dirty.clear()
+            if not rows:
+                return 0
+            try:
+                inserted = self._write_rows(rows)
+            except sqlite3.OperationalError:
+                # Likely transient (busy, locked, I/O): keep the points for the next
+                # flush, but drop them once the batch has failed repeatedly
+                self._flush_failures += 1
+                if self._flush_failures < _MAX_FLUSH_ATTEMPTS:
+                    with self._buf_lock:
+                        self._buf.extendleft(reversed(rows))
+                        self._dirty.update((r[0], r[1]) for r in rows)
+                else:
+                    self._flush_failures = 0
+                raise
+            self._flush_failures = 0
+            self._remember_rows(rows, inserted)
+            return inserted
 
-        labels_json = json.dumps(labels or {})
-        c.execute("""
-            INSERT OR IGNORE INTO metrics (name, labels, value, timestamp, created_at)
-            VALUES (?, ?, ?, ?, ?)
-        """, (name, labels_json, value, metric.timestamp.isoformat(), datetime.now().isoformat()))
+    def push_metrics(self, points: List[Tuple]) -> int:
+        """Store a batch of (name, value, labels[, timestamp]) points in one transaction"""
+        rows = []
+        now_us = None
+        offsets: Dict[Tuple[str, str], int] = {}
+        for point in points:
+            name, value, labels = point[:3]
+            value = _to_value(value)
+            labels_json = _canon_labels(labels)
+            if len(point) > 3:
+                ts_us = _to_us(point[3])
+            else:
+                # One clock read per batch; same-series points are spaced 1us
+                # apart so UNIQUE(name, labels, timestamp) keeps them all
+                if now_us is None:
+                    now_us = _to_us(datetime.now())
+                offset = offsets.get((name, labels_json), 0)
+                offsets[(name, labels_json)] = offset + 1
+                ts_us = now_us + offset
+            rows.append((name, labels_json, value, ts_us))
 
-        conn.commit()
-        conn.close()
-        return metric
+        inserted = self._write_rows(rows)
+        self._remember_rows(rows, inserted)
+        return inserted
+
+    def _write_rows(self, rows: List[Tuple]) -> int:
+        """Insert prepared metric rows and fold them into metric_stats atomically"""
+        with self._lock:
+            c = self._conn.cursor()
+            # IMMEDIATE takes the write lock up front: a deferred transaction that
+            # reads first cannot wait out busy_timeout when upgrading in WAL mode
+            c.execute("BEGIN IMMEDIATE")
+            try:
+                c.execute(SQL_MAX_METRIC_ID)
+                last_id = c.fetchone()[0]
+                c.executemany(SQL_INS_METRIC, rows)
+                inserted = c.rowcount
+                if inserted == len(rows):
+                    self._update_stats(c, rows)
+                elif inserted:
+                    # Some points were ignored as duplicates; fold in only the
+                    # rows that landed (ids are AUTOINCREMENT, so all are newer)
+                    c.execute(SQL_SEL_METRICS_SINCE, (last_id,))
+                    self._update_stats(c, c.fetchall())
+                c.execute("COMMIT")
+            except BaseException:
+                c.execute("ROLLBACK")
+                raise
+        return inserted
+
+    def _remember_rows(self, rows: List[Tuple], inserted: int):
+        """Advance already-cached series to the newest committed value in rows"""
+        if inserted != len(rows):
+            # Some rows were ignored duplicates, so their values never landed
+            return
+        now = time.monotonic()
+        with self._buf_lock:
+            for row in rows:
+                key = (row[0], row[1])
+                # Entries are only created from a database read in
+                # get_current_value; a write alone cannot tell whether the
+                # table already holds a newer point (backfill, reopened file)
+                if key in self._current:
+                    self._remember(key, row[3], row[2], now)
+
+    def _remember(self, key: Tuple[str, str], ts_us: int, value: float, now: float):
+        """Cache a committed value unless a newer one is cached or still buffered
+
+        Caller holds _buf_lock.
+        """
+        if key in self._dirty:
+            return
+        cached = self._current.get(key)
+        if cached is None or ts_us >= cached[0]:
+            self._current[key] = (ts_us, value, now)
+        self._current.move_to_end(key)
+        if len(self._current) > _CURRENT_MAX:
+            self._current.popitem(last=False)
 
     def query_metrics(self, name: str, labels: Dict[str, str] = None,
                      from_ts: Optional[datetime] = None, to_ts: Optional[datetime] = None,
-                     step_s: int = 60) -> List[Tuple[str, float]]:
-        """Query metric time series data"""
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
+                     step_s: Optional[int] = None) -> List[Tuple[str, float]]:
+        """Query metric time series data, averaged into step_s buckets if given"""
+        self.flush()
+        with self._lock:
+            c = self._conn.cursor()
+            self._select_series(c, name, labels, from_ts, to_ts, step_s)
+            return [(_from_us(ts).isoformat(), value) for ts, value in c]
 
-        labels_json = json.dumps(labels or {})
+    def query_metrics_iter(self, name: str, labels: Dict[str, str] = None,
+                           from_ts: Optional[datetime] = None,
+                           to_ts: Optional[datetime] = None,
+                           step_s: Optional[int] = None) -> Iterator[Tuple[int, float]]:
+        """Lazily yield (epoch-microsecond timestamp, value) rows of a series
 
-        if from_ts and to_ts:
-            c.execute("""
-                SELECT timestamp, value FROM metrics
-                WHERE name = ? AND labels = ? AND timestamp BETWEEN ? AND ?
-                ORDER BY timestamp ASC
-            """, (name, labels_json, from_ts.isoformat(), to_ts.isoformat()))
-        else:
-            c.execute("""
-                SELECT timestamp, value FROM metrics WHERE name = ? AND labels = ?
-                ORDER BY timestamp ASC
-            """, (name, labels_json))
+        Rows reflect the database as of this call; points written while the
+        iterator is consumed are not included.
+        """
+        self.flush()
+        if self.db_path == ":memory:":
+            # A private database has no second connection to read a snapshot
+            # from, so materialize it under the lock instead
+            with self._lock:
+                c = self._conn.cursor()
+                self._select_series(c, name, labels, from_ts, to_ts, step_s)
+                return iter(c.fetchall())
+        # A separate connection holding a read transaction sees a fixed WAL
+        # snapshot, so chunks stream without blocking or seeing later writers
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        try:
+            conn.execute("PRAGMA busy_timeout=5000")
+            c = conn.cursor()
+            c.execute("BEGIN")
+            # Executing the select takes the snapshot now, not at first next()
+            self._select_series(c, name, labels, from_ts, to_ts, step_s)
+        except BaseException:
+            conn.close()
+            raise
+        return _stream_rows(conn, c)
 
-        results = c.fetchall()
-        conn.close()
-        return [(r[0], r[1]) for r in results]
+    def query_metrics_arrays(self, name: str, labels: Dict[str, str] = None,
+                             from_ts: Optional[datetime] = None,
+                             to_ts: Optional[datetime] = None,
+                             step_s: Optional[int] = None) -> Tuple["np.ndarray", "np.ndarray"]:
+        """Query a series as (int64 epoch-microsecond timestamps, float64 values) arrays"""
+        if np is None:
+            raise ImportError("query_metrics_arrays requires numpy")
+        self.flush()
+        with self._lock:
+            c = self._conn.cursor()
+            self._select_series(c, name, labels, from_ts, to_ts, step_s)
+            # Rows go straight from the cursor into one structured buffer
+            rows = np.fromiter(c, dtype=[("timestamp", np.int64), ("value", np.float64)])
+        return np.ascontiguousarray(rows["timestamp"]), np.ascontiguousarray(rows["value"])
+
+    def _select_series(self, c: sqlite3.Cursor, name: str, labels: Optional[Dict[str, str]],
+                       from_ts: Optional[datetime], to_ts: Optional[datetime],
+                       step_s: Optional[int] = None):
+        """Execute the (timestamp, value) select for a series on the given cursor"""
+        labels_json = _canon_labels(labels)
+        if step_s is not None:
+            # Bucket in SQL so only one averaged row per step leaves SQLite
+            step_us = int(step_s * 1_000_000)
+            if step_us < 1:
+                raise ValueError(f"step_s must be at least one microsecond, got {step_s!r}")
+            if from_ts and to_ts:
+                c.execute(SQL_SEL_BUCKETS_RANGE, (step_us, step_us, name, labels_json,
+                                                  _to_us(from_ts), _to_us(to_ts), step_us))
+            else:
+                c.execute(SQL_SEL_BUCKETS_ALL, (step_us, step_us, name, labels_json, step_us))
+        elif from_ts and to_ts:
+            c.execute(SQL_SEL_METRICS_RANGE,
+                      (name, labels_json, _to_us(from_ts), _to_us(to_ts)))
+        else:
+            c.execute(SQL_SEL_METRICS_ALL, (name, labels_json))
 
     def export_json(self, dashboard_id: str) -> str:
         """Export dashboard as Grafana-compatible JSON"""
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-
-        c.execute("SELECT * FROM dashboards WHERE id = ?", (dashboard_id,))
-        row = c.fetchone()
-        conn.close()
-
-        if not row:
-            return "{}"
+        with self._lock:
+            c = self._conn.cursor()
+            c.row_factory = sqlite3.Row
+            c.execute(SQL_SEL_DASH, (dashboard_id,))
+            row = c.fetchone()
+            if not row:
+                return "{}"
+            c.execute(SQL_SEL_PANELS, (dashboard_id,))
+            panel_rows = c.fetchall()
+            c.execute(SQL_SEL_VARIABLES, (dashboard_id,))
+            variable_rows = c.fetchall()
 
         dashboard_json = {
-            "id": row[0],
-            "uid": row[1],
-            "title": row[2],
-            "description": row[3],
-            "tags": json.loads(row[4]),
-            "panels": json.loads(row[5]),
-            "variables": json.loads(row[6]),
-            "refresh": row[7],
-            "time": {"from": "now-" + row[8], "to": "now"},
-            "created_at": row[9]
+            "id": row["id"],
+            "uid": row["uid"],
+            "title": row["title"],
+            "description": row["description"],
+            "tags": _loads(row["tags"]),
+            "panels": [
+                {"id": p["id"], "title": p["title"], "type": p["type"],
+                 "datasource": p["datasource"], "query": p["query"],
+                 "options": _loads(p["options"]),
+                 "position": {"x": p["pos_x"], "y": p["pos_y"], "w": p["w"], "h": p["h"]},
+                 **(_loads(p["extra"]) if p["extra"] else {})}
+                for p in panel_rows
+            ],
+            "variables": [dict(v) for v in variable_rows],
+            "refresh": row["refresh_interval"],
+            "time": {"from": "now-" + row["time_range"], "to": "now"},
+            "created_at": row["created_at"]
         }
-        return json.dumps(dashboard_json, indent=2)
+        return _dumps(dashboard_json, indent=True)
 
     def import_json(self, json_str: str) -> Dashboard:
         """Import dashboard from JSON"""
-        import hashlib
-        data = json.loads(json_str)
+        data = _loads(json_str)
 
-        dashboard_id = hashlib.md5(data.get("title", "").encode()).hexdigest()[:8]
+        dashboard_id = blake2b(data.get("title", "").encode(), digest_size=4).hexdigest()
         dashboard = Dashboard(
             id=dashboard_id,
             uid=data.get("uid", dashboard_id),
@@ -313,62 +966,236 @@ class DashboardBuilder:
             created_at=datetime.now()
         )
 
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute("""
-            INSERT OR REPLACE INTO dashboards VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            dashboard.id, dashboard.uid, dashboard.title, dashboard.description,
-            json.dumps(dashboard.tags), json.dumps(data.get("panels", [])),
-            json.dumps(data.get("variables", [])),
-            dashboard.refresh_interval, dashboard.time_range,
-            dashboard.created_at.isoformat()
-        ))
-        conn.commit()
-        conn.close()
+        with self._lock:
+            c = self._conn.cursor()
+            c.execute("BEGIN IMMEDIATE")
+            try:
+                # REPLACE may evict a row by id or by uid; drop its children too
+                c.execute(SQL_SEL_DASH_IDS, (dashboard.id, dashboard.uid))
+                for (replaced_id,) in c.fetchall():
+                    c.execute(SQL_DEL_PANELS, (replaced_id,))
+                    c.execute(SQL_DEL_VARIABLES, (replaced_id,))
+                c.execute(SQL_REPLACE_DASH, (
+                    dashboard.id, dashboard.uid, dashboard.title, dashboard.description,
+                    _dumps(dashboard.tags) if dashboard.tags else _EMPTY_JSON_ARRAY,
+                    dashboard.refresh_interval, dashboard.time_range,
+                    dashboard.created_at.isoformat()
+                ))
+                self._insert_children(c, dashboard.id, data.get("panels", []),
+                                      data.get("variables", []))
+                c.execute("COMMIT")
+            except BaseException:
+                c.execute("ROLLBACK")
+                raise
         return dashboard
 
     def get_current_value(self, name: str, labels: Dict[str, str] = None) -> Optional[float]:
         """Get the latest metric value"""
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-
-        labels_json = json.dumps(labels or {})
-        c.execute("""
-            SELECT value FROM metrics
-            WHERE name = ? AND labels = ?
-            ORDER BY timestamp DESC LIMIT 1
-        """, (name, labels_json))
+        key = (name, _canon_labels(labels))
+        with self._buf_lock:
+            cached = self._current.get(key)
+            if cached is not None and key not in self._dirty:
+                if time.monotonic() - cached[2] < _CURRENT_TTL:
+                    self._current.move_to_end(key)
+                    return cached[1]
+                del self._current[key]
 
-        result = c.fetchone()
-        conn.close()
-        return result[0] if result else None
+        self.flush()
+        with self._lock:
+            c = self._conn.cursor()
+            c.execute(SQL_SEL_CURRENT, key)
+            result = c.fetchone()
+        if not result:
+            return None
+        with self._buf_lock:
+            self._remember(key, result[0], result[1], time.monotonic())
+        return result[1]
 
     def get_stats(self, name: str, labels: Dict[str, str] = None,
                  from_ts: Optional[datetime] = None) -> Dict:
         """Calculate statistics for a metric"""
-        metrics = self.query_metrics(name, labels, from_ts)
+        if from_ts is None:
+            return self._get_running_stats(name, labels)
 
-        if not metrics:
-            return {"error": "No data found"}
+        self.flush()
+        labels_json = _canon_labels(labels)
+        with self._lock:
+            c = self._conn.cursor()
+            from_us = _to_us(from_ts)
+            c.execute(SQL_AGG_SERIES_FROM, (name, labels_json, from_us))
+            low, high, avg, count = c.fetchone()
+            if not count:
+                return {"error": "No data found"}
 
-        values = [m[1] for m in metrics]
-        sorted_values = sorted(values)
-
-        p95_idx = int(len(sorted_values) * 0.95)
+            c.execute(SQL_P95_SERIES_FROM, (name, labels_json, from_us,
+                                            min(int(count * 0.95), count - 1)))
+            p95 = c.fetchone()[0]
 
         stats = {
             "name": name,
             "labels": labels or {},
-            "min": min(values),
-            "max": max(values),
-            "avg": statistics.mean(values),
-            "p95": sorted_values[p95_idx] if p95_idx < len(sorted_values) else sorted_values[-1],
-            "count": len(values)
+            "min": low,
+            "max": high,
+            "avg": avg,
+            "p95": p95,
+            "count": count
         }
 
         return stats
 
+    def _get_running_stats(self, name: str, labels: Dict[str, str] = None) -> Dict:
+        """Read the incrementally maintained all-time statistics for a series"""
+        self.flush()
+        with self._lock:
+            c = self._conn.cursor()
+            c.execute(SQL_SEL_STATS, (name, _canon_labels(labels)))
+            row = c.fetchone()
+
+        if not row:
+            return {"error": "No data found"}
+
+        reservoir = _unpack_reservoir(row[3])
+        return {
+            "name": name,
+            "labels": labels or {},
+            "min": row[0],
+            "max": row[1],
+            "avg": row[2],
+            "p95": _p95(reservoir) if reservoir else None,
+            "count": row[4]
+        }
+
+
+def _stream_rows(conn: sqlite3.Connection, c: sqlite3.Cursor) -> Iterator[Tuple[int, float]]:
+    """Yield a cursor's rows one chunk at a time, then close its connection"""
+    try:
+        while True:
+            chunk = c.fetchmany(_FETCH_CHUNK)
+            if not chunk:
+                return
+            yield from chunk
+    finally:
+        conn.close()
+
+
+def _flusher_loop(ref: "weakref.ReferenceType[DashboardBuilder]", wake: threading.Event,
+                  closed: threading.Event, interval: float):
+    """Background loop flushing a builder's buffer by size or interval"""
+    while not closed.is_set():
+        wake.wait(interval)
+        wake.clear()
+        builder = ref()
+        if builder is None:
+            return
+        try:
+            builder.flush()
+        except Exception:
+            # Keep the thread alive; the failure is reported, not swallowed
+            logger.exception("Background metric flush failed")
+        del builder
+
+
+def _close_if_alive(ref: "weakref.ReferenceType[DashboardBuilder]"):
+    """atexit hook closing a builder that is still referenced at shutdown"""
+    builder = ref()
+    if builder is not None:
+        builder.close()
+
+
+class AsyncMetricWriter:
+    """Asyncio ingest front end with one batching writer task per metric name"""
+
+    def __init__(self, builder: DashboardBuilder, batch_size: int = 500,
+                 max_delay: float = 1.0, max_queue: int = 10_000):
+        self.builder = builder
+        self._batch_size = batch_size
+        self._max_delay = max_delay
+        self._max_queue = max_queue
+        self._queues: Dict[str, asyncio.Queue] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._flush_requested = asyncio.Event()
+        self._error: Optional[BaseException] = None
+
+    async def push_metric(self, name: str, value: float,
+                          labels: Dict[str, str] = None) -> Metric:
+        """Queue a metric data point on its series writer"""
+        value = _to_value(value)
+        metric = Metric(
+            name=name,
+            labels=labels or {},
+            value=value,
+            timestamp=datetime.now()
+        )
+        queue = self._queues.get(name)
+        if queue is None:
+            # Bounded so a slow or failing writer applies backpressure to producers
+            queue = self._queues[name] = asyncio.Queue(maxsize=self._max_queue)
+            self._tasks[name] = asyncio.create_task(self._writer(queue))
+        await queue.put((name, value, labels, metric.timestamp))
+        return metric
+
+    async def flush(self):
+        """Write out everything queued so far without waiting for max_delay
+
+        Raises the first write error seen since the previous flush; the
+        points in that failed batch are dropped.
+        """
+        self._flush_requested.set()
+        try:
+            await asyncio.gather(*(queue.join() for queue in self._queues.values()))
+        finally:
+            self._flush_requested.clear()
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    async def close(self):
+        """Flush and stop all writer tasks"""
+        try:
+            await self.flush()
+        finally:
+            for task in self._tasks.values():
+                task.cancel()
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+            self._queues.clear()
+            self._tasks.clear()
+
+    async def _writer(self, queue: asyncio.Queue):
+        """Coalesce up to batch_size points or max_delay seconds per write"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await queue.get()]
+            deadline = loop.time() + self._max_delay
+            while len(batch) < self._batch_size:
+                if not queue.empty():
+                    batch.append(queue.get_nowait())
+                    continue
+                remaining = deadline - loop.time()
+                if remaining <= 0 or self._flush_requested.is_set():
+                    break
+                getter = asyncio.ensure_future(queue.get())
+                flushed = asyncio.ensure_future(self._flush_requested.wait())
+                await asyncio.wait({getter, flushed}, timeout=remaining,
+                                   return_when=asyncio.FIRST_COMPLETED)
+                flushed.cancel()
+                getter.cancel()
+                if getter.done() and not getter.cancelled():
+                    batch.append(getter.result())
+                else:
+                    break
+            try:
+                # The commit runs off-loop so other series keep marshaling meanwhile
+                await asyncio.to_thread(self.builder.push_metrics, batch)
+            except Exception as exc:
+                # Keep consuming so queue.join() in flush() still returns
+                logger.exception("Async metric write failed; dropped %d points",
+                                 len(batch))
+                if self._error is None:
+                    self._error = exc
+            finally:
+                for _ in batch:
+                    queue.task_done()
+
 
 if __name__ == "__main__":
     print("BlackRoad Dashboard Builder")
@@ -1,5 +1,15 @@
+import asyncio
+import gc
+import json
 import pytest
-from src.dashboard_builder import DashboardBuilder
+import sqlite3
+import threading
+import time
+import weakref
+from datetime import datetime, timedelta
+from decimal import Decimal
+from src.dashboard_builder import (AsyncMetricWriter, DashboardBuilder, Metric, Position,
+                                  SCHEMA_VERSION)
 
 def test_create_dashboard():
     builder = DashboardBuilder(":memory:")
@@ -11,3 +21,453 @@ def test_push_metric():
     metric = builder.push_metric("test_metric", 100.0)
     assert metric.name == "test_metric"
     assert metric.value == 100.0
+
+def test_memory_db_persists_across_calls():
+    builder = DashboardBuilder(":memory:")
+    builder.push_metric("cpu", 1.0, {"node": "a"})
+    builder.push_metric("cpu", 2.0, {"node": "a"})
+    assert [v for _, v in builder.query_metrics("cpu", {"node": "a"})] == [1.0, 2.0]
+    assert builder.get_current_value("cpu", {"node": "a"}) == 2.0
+    builder.close()
+
+def test_file_db_uses_wal(tmp_path):
+    with DashboardBuilder(str(tmp_path / "dash.db")) as builder:
+        mode = builder._conn.execute("PRAGMA journal_mode").fetchone()[0]
+        assert mode == "wal"
+
+def test_push_metrics_batch():
+    builder = DashboardBuilder(":memory:")
+    points = [("mem", float(i), {"node": "a"}) for i in range(100)]
+    assert builder.push_metrics(points) == 100
+    assert len(builder.query_metrics("mem", {"node": "a"})) == 100
+
+def test_push_metric_is_buffered_until_flush():
+    builder = DashboardBuilder(":memory:", flush_interval=60)
+    for i in range(10):
+        builder.push_metric("disk", float(i))
+    assert len(builder._buf) == 10
+    assert builder.flush() == 10
+    assert len(builder._buf) == 0
+    assert builder.get_current_value("disk") == 9.0
+    builder.close()
+
+def test_close_flushes_buffer(tmp_path):
+    db_path = str(tmp_path / "dash.db")
+    builder = DashboardBuilder(db_path, flush_interval=60)
+    builder.push_metric("disk", 1.0)
+    builder.close()
+    with DashboardBuilder(db_path) as reopened:
+        assert reopened.get_current_value("disk") == 1.0
+
+def test_labels_are_order_insensitive():
+    builder = DashboardBuilder(":memory:")
+    builder.push_metric("net", 5.0, {"a": "1", "b": "2"})
+    assert builder.get_current_value("net", {"b": "2", "a": "1"}) == 5.0
+    assert len(builder.query_metrics("net", {"b": "2", "a": "1"})) == 1
+
+def test_get_stats_uses_running_aggregates():
+    builder = DashboardBuilder(":memory:")
+    builder.push_metrics([("lat", float(v), {}) for v in range(1, 101)])
+    builder.push_metrics([("lat", 1000.0, {})])
+    stats = builder.get_stats("lat")
+    assert stats["count"] == 101
+    assert stats["min"] == 1.0
+    assert stats["max"] == 1000.0
+    assert stats["avg"] == (5050.0 + 1000.0) / 101
+    assert stats["p95"] == 96.0
+    assert builder.get_stats("missing") == {"error": "No data found"}
+
+def test_duplicate_points_fold_only_new_rows_into_stats(monkeypatch):
+    builder = DashboardBuilder(":memory:")
+    t0, t1 = datetime(2024, 1, 1), datetime(2024, 1, 2)
+    builder.push_metrics([("lat", 1.0, {}, t0)])
+    monkeypatch.setattr(builder, "_rebuild_stats", None)
+    assert builder.push_metrics([("lat", 9.0, {}, t0), ("lat", 3.0, {}, t1)]) == 1
+    stats = builder.get_stats("lat")
+    assert (stats["min"], stats["max"], stats["avg"], stats["count"]) == (1.0, 3.0, 2.0, 2)
+
+def test_reservoir_is_stored_packed_and_json_reservoirs_still_load():
+    builder = DashboardBuilder(":memory:")
+    builder.push_metrics([("lat", float(v), {}) for v in range(1, 101)])
+    kind = builder._conn.execute("SELECT typeof(reservoir) FROM metric_stats").fetchone()[0]
+    assert kind == "blob"
+    # Rows written before the reservoir was packed hold JSON text
+    builder._conn.execute("UPDATE metric_stats SET reservoir = ?",
+                          (json.dumps([float(v) for v in range(1, 101)]),))
+    assert builder.get_stats("lat")["p95"] == 96.0
+    builder.push_metrics([("lat", 1000.0, {})])
+    stats = builder.get_stats("lat")
+    assert (stats["count"], stats["max"], stats["p95"]) == (101, 1000.0, 96.0)
+
+def test_get_stats_from_ts():
+    builder = DashboardBuilder(":memory:")
+    builder.push_metrics([("lat", float(v), {}) for v in range(1, 101)])
+    stats = builder.get_stats("lat", from_ts=datetime(2000, 1, 1))
+    assert stats["count"] == 100
+    assert (stats["min"], stats["max"], stats["avg"]) == (1.0, 100.0, 50.5)
+    assert stats["p95"] == 96.0
+
+def test_get_stats_from_ts_filters_range():
+    builder = DashboardBuilder(":memory:")
+    builder.push_metrics([("lat", 1.0, {}, datetime(2024, 1, 1)),
+                          ("lat", 3.0, {}, datetime(2024, 1, 2)),
+                          ("lat", 5.0, {}, datetime(2024, 1, 3))])
+    stats = builder.get_stats("lat", from_ts=datetime(2024, 1, 2))
+    assert (stats["min"], stats["max"], stats["avg"], stats["count"]) == (3.0, 5.0, 4.0, 2)
+    assert builder.get_stats("lat", from_ts=datetime(2025, 1, 1)) == {"error": "No data found"}
+
+def test_export_import_roundtrip():
+    builder = DashboardBuilder(":memory:")
+    dashboard = builder.create_dashboard("Ops", tags=["prod"])
+    builder.add_panel(dashboard.id, "CPU", "timeseries", "rate(cpu[5m])")
+    builder.add_variable(dashboard.id, "node", "label_values(node)")
+    exported = json.loads(builder.export_json(dashboard.id))
+    assert exported["tags"] == ["prod"]
+    assert [p["title"] for p in exported["panels"]] == ["CPU"]
+    assert [v["name"] for v in exported["variables"]] == ["node"]
+    imported = builder.import_json(json.dumps(exported))
+    assert imported.title == "Ops"
+    assert json.loads(builder.export_json(imported.id))["panels"] == exported["panels"]
+
+GRAFANA_PANEL = {
+    "id": 2,
+    "title": "Requests",
+    "type": "timeseries",
+    "datasource": {"type": "prometheus", "uid": "P1809F7CD0C75ACF3"},
+    "targets": [{"expr": "rate(http_requests_total[5m])", "refId": "A"}],
+    "fieldConfig": {"defaults": {"unit": "reqps"}, "overrides": []},
+    "gridPos": {"x": 0, "y": 0, "w": 12, "h": 8},
+}
+
+def test_import_grafana_panel_roundtrips():
+    builder = DashboardBuilder(":memory:")
+    imported = builder.import_json(json.dumps({"title": "Web", "panels": [GRAFANA_PANEL]}))
+    panel = json.loads(builder.export_json(imported.id))["panels"][0]
+    assert {k: panel[k] for k in GRAFANA_PANEL} == GRAFANA_PANEL
+    assert panel["position"] == GRAFANA_PANEL["gridPos"]
+
+def test_baseline_db_with_grafana_panel_opens(tmp_path):
+    db_path = str(tmp_path / "dash.db")
+    conn = sqlite3.connect(db_path)
+    conn.execute("""
+        CREATE TABLE dashboards (id TEXT PRIMARY KEY, uid TEXT UNIQUE, title TEXT NOT NULL,
+                                 description TEXT, tags TEXT, panels TEXT, variables TEXT,
+                                 refresh_interval TEXT DEFAULT '30s',
+                                 time_range TEXT DEFAULT '1h', created_at TEXT)
+    """)
+    conn.execute("INSERT INTO dashboards VALUES ('d1', 'u1', 'Web', '', '[]', ?, '[]', "
+                 "'30s', '1h', '2024-01-01T00:00:00')", (json.dumps([GRAFANA_PANEL]),))
+    conn.commit()
+    conn.close()
+    with DashboardBuilder(db_path) as builder:
+        panel = json.loads(builder.export_json("d1"))["panels"][0]
+    assert {k: panel[k] for k in GRAFANA_PANEL} == GRAFANA_PANEL
+
+def test_query_metrics_range_on_integer_timestamps():
+    builder = DashboardBuilder(":memory:")
+    stamps = [datetime(2024, 1, 1, 0, m, 0, 123456) for m in range(5)]
+    builder.push_metrics([("temp", float(i), {}, ts) for i, ts in enumerate(stamps)])
+    assert builder._conn.execute("SELECT typeof(timestamp) FROM metrics").fetchone()[0] == "integer"
+    results = builder.query_metrics("temp", from_ts=stamps[1], to_ts=stamps[3])
+    assert results == [(ts.isoformat(), float(i + 1)) for i, ts in enumerate(stamps[1:4])]
+
+def test_query_metrics_arrays():
+    np = pytest.importorskip("numpy")
+    builder = DashboardBuilder(":memory:")
+    stamps = [datetime(2024, 1, 1, 0, m) for m in range(3)]
+    builder.push_metrics([("temp", float(i), {}, ts) for i, ts in enumerate(stamps)])
+    ts, values = builder.query_metrics_arrays("temp")
+    assert ts.dtype == np.int64 and values.dtype == np.float64
+    assert values.tolist() == [0.0, 1.0, 2.0]
+    assert ts.tolist() == [int(t.timestamp()) * 1_000_000 for t in stamps]
+
+def test_query_metrics_downsamples_by_step():
+    builder = DashboardBuilder(":memory:")
+    base = datetime(2024, 1, 1)
+    builder.push_metrics([("rps", float(s), {}, base + timedelta(seconds=s)) for s in range(120)])
+    assert len(builder.query_metrics("rps")) == 120
+    buckets = builder.query_metrics("rps", step_s=60)
+    assert buckets == [(base.isoformat(), 29.5),
+                       ((base + timedelta(seconds=60)).isoformat(), 89.5)]
+    ranged = builder.query_metrics("rps", from_ts=base, to_ts=base + timedelta(seconds=59),
+                                   step_s=30)
+    assert [v for _, v in ranged] == [14.5, 44.5]
+
+@pytest.mark.parametrize("step_s", [0, -60, 1e-7])
+def test_query_metrics_rejects_bad_step(step_s):
+    builder = DashboardBuilder(":memory:")
+    builder.push_metric("rps", 1.0)
+    with pytest.raises(ValueError):
+        builder.query_metrics("rps", step_s=step_s)
+
+def test_metric_is_slotted_and_frozen():
+    builder = DashboardBuilder(":memory:")
+    metric = builder.push_metric("cpu", 1.0)
+    assert not hasattr(metric, "__dict__")
+    with pytest.raises(AttributeError):
+        metric.value = 2.0
+
+def test_metric_is_hashable():
+    ts = datetime(2024, 1, 1)
+    a = Metric("cpu", {"node": "a"}, 1.0, ts)
+    b = Metric("cpu", {"node": "a"}, 1.0, ts)
+    assert a == b and hash(a) == hash(b)
+    assert a != Metric("cpu", {"node": "b"}, 1.0, ts)
+    assert len({a, b}) == 1
+
+def test_get_current_value_is_served_from_cache(monkeypatch):
+    builder = DashboardBuilder(":memory:")
+    builder.push_metric("cpu", 1.0, {"node": "a"})
+    assert builder.get_current_value("cpu", {"node": "a"}) == 1.0
+    builder.push_metric("cpu", 2.0, {"node": "a"})
+    builder.push_metrics([("cpu", 0.5, {"node": "a"}, datetime(2000, 1, 1))])
+    builder.flush()
+    builder._conn.execute("DELETE FROM metrics")
+    assert builder.get_current_value("cpu", {"node": "a"}) == 2.0
+    monkeypatch.setattr("src.dashboard_builder._CURRENT_TTL", 0.0)
+    assert builder.get_current_value("cpu", {"node": "a"}) is None
+
+def test_current_value_cache_is_bounded_and_holds_committed_values(monkeypatch):
+    monkeypatch.setattr("src.dashboard_builder._CURRENT_MAX", 3)
+    builder = DashboardBuilder(":memory:")
+    builder.push_metrics([(f"s{i}", float(i), {}) for i in range(6)])
+    assert not builder._current
+    for i in range(5):
+        builder.get_current_value(f"s{i}")
+    assert list(builder._current) == [("s2", "{}"), ("s3", "{}"), ("s4", "{}")]
+    builder.get_current_value("s2")
+    builder.get_current_value("s5")
+    assert ("s3", "{}") not in builder._current
+    builder.push_metric("s2", 9.0)
+    assert builder.get_current_value("s2") == 9.0
+
+def test_writes_do_not_cache_values_older_than_the_table(tmp_path):
+    db_path = str(tmp_path / "dash.db")
+    with DashboardBuilder(db_path) as builder:
+        builder.push_metrics([("temp", 1.0, {}, datetime(2024, 1, 2))])
+    builder = DashboardBuilder(db_path)
+    builder.push_metrics([("temp", 5.0, {}, datetime(2024, 1, 1))])
+    assert builder.get_current_value("temp") == 1.0
+    builder.push_metrics([("temp", 7.0, {}, datetime(2023, 12, 31))])
+    assert builder.get_current_value("temp") == 1.0
+    builder.push_metrics([("temp", 3.0, {}, datetime(2024, 1, 3))])
+    assert builder.get_current_value("temp") == 3.0
+    builder.close()
+
+def test_panels_are_stored_as_rows():
+    builder = DashboardBuilder(":memory:")
+    dashboard = builder.create_dashboard("Many panels")
+    for i in range(20):
+        builder.add_panel(dashboard.id, f"panel {i}", "stat", f"up{{job='{i}'}}",
+                          position=Position(x=i, y=0, w=4, h=4))
+    builder.add_panel("missing", "orphan", "stat", "up")
+    count = builder._conn.execute("SELECT COUNT(*) FROM panels").fetchone()[0]
+    assert count == 20
+    panels = json.loads(builder.export_json(dashboard.id))["panels"]
+    assert [p["position"]["x"] for p in panels] == list(range(20))
+
+def test_async_writer_batches_per_series():
+    builder = DashboardBuilder(":memory:")
+
+    async def ingest():
+        writer = AsyncMetricWriter(builder, batch_size=50, max_delay=60)
+        for i in range(120):
+            await writer.push_metric(f"series_{i % 3}", float(i))
+        await writer.flush()
+        counts = [len(builder.query_metrics(f"series_{k}")) for k in range(3)]
+        await writer.close()
+        return counts
+
+    assert asyncio.run(ingest()) == [40, 40, 40]
+
+def test_async_writer_survives_a_failed_write(monkeypatch):
+    builder = DashboardBuilder(":memory:")
+    real_push = builder.push_metrics
+    calls = []
+
+    def flaky_push(points):
+        calls.append(len(points))
+        if len(calls) == 1:
+            raise RuntimeError("disk full")
+        return real_push(points)
+
+    monkeypatch.setattr(builder, "push_metrics", flaky_push)
+
+    async def ingest():
+        writer = AsyncMetricWriter(builder, batch_size=10, max_delay=60)
+        await writer.push_metric("cpu", 1.0)
+        with pytest.raises(RuntimeError):
+            await asyncio.wait_for(writer.flush(), timeout=5)
+        await writer.push_metric("cpu", 2.0)
+        await asyncio.wait_for(writer.close(), timeout=5)
+
+    asyncio.run(ingest())
+    assert [v for _, v in builder.query_metrics("cpu")] == [2.0]
+
+def test_query_metrics_iter_streams_in_chunks(monkeypatch):
+    monkeypatch.setattr("src.dashboard_builder._FETCH_CHUNK", 7)
+    builder = DashboardBuilder(":memory:")
+    base = datetime(2024, 1, 1)
+    builder.push_metrics([("io", float(s), {}, base + timedelta(seconds=s)) for s in range(30)])
+    rows = builder.query_metrics_iter("io")
+    first = next(rows)
+    assert first == (int(base.timestamp()) * 1_000_000, 0.0)
+    builder.push_metric("other", 1.0)
+    assert [v for _, v in rows] == [float(s) for s in range(1, 30)]
+
+@pytest.mark.parametrize("on_disk", [False, True])
+def test_query_metrics_iter_reads_a_snapshot(tmp_path, monkeypatch, on_disk):
+    monkeypatch.setattr("src.dashboard_builder._FETCH_CHUNK", 3)
+    builder = DashboardBuilder(str(tmp_path / "dash.db") if on_disk else ":memory:")
+    base = datetime(2024, 1, 1)
+    builder.push_metrics([("io", float(s), {}, base + timedelta(seconds=s)) for s in range(10)])
+    rows = builder.query_metrics_iter("io")
+    builder.push_metric("io", 99.0)
+    first = next(rows)
+    builder.push_metrics([("io", 100.0, {}, base - timedelta(seconds=1))])
+    assert len([first, *rows]) == 10
+    assert len(builder.query_metrics("io")) == 12
+    builder.close()
+
+def test_init_db_is_skipped_at_current_schema_version(tmp_path):
+    db_path = str(tmp_path / "dash.db")
+    with DashboardBuilder(db_path) as builder:
+        version = builder._conn.execute("PRAGMA user_version").fetchone()[0]
+        assert version == SCHEMA_VERSION
+        builder.push_metric("cpu", 1.0)
+    with DashboardBuilder(db_path) as reopened:
+        assert reopened.get_current_value("cpu") == 1.0
+
+def test_push_metrics_shares_one_batch_timestamp():
+    builder = DashboardBuilder(":memory:")
+    assert builder.push_metrics([("q", float(i), {}) for i in range(1000)]) == 1000
+    ts, _ = zip(*builder.query_metrics_iter("q"))
+    assert list(ts) == list(range(ts[0], ts[0] + 1000))
+
+def test_bad_values_fail_at_the_call_site():
+    builder = DashboardBuilder(":memory:", flush_interval=60)
+    with pytest.raises(ValueError):
+        builder.push_metric("s", "abc")
+    with pytest.raises(TypeError):
+        builder.push_metrics([("s", None, {})])
+    builder.push_metric("ok", Decimal("1.5"))
+    builder.push_metric("ok", 2)
+    assert builder.flush() == 2
+    assert builder.get_stats("ok")["count"] == 2
+    builder.close()
+
+def test_nan_is_rejected_and_null_stats_recover():
+    builder = DashboardBuilder(":memory:")
+    with pytest.raises(ValueError):
+        builder.push_metric("lat", float("nan"))
+    with pytest.raises(ValueError):
+        builder.push_metrics([("z", 1.0, {}), ("lat", float("inf"), {})])
+    assert builder.get_stats("z") == {"error": "No data found"}
+    # A series poisoned by a NaN stored before values were validated
+    builder._conn.execute("INSERT INTO metrics (name, labels, value, timestamp) "
+                          "VALUES ('lat', '{}', NULL, 1)")
+    builder._conn.execute("INSERT INTO metric_stats (name, labels, count, reservoir) "
+                          "VALUES ('lat', '{}', 1, '[]')")
+    builder.push_metrics([("lat", 2.0, {}), ("lat", 4.0, {}), ("z", 1.0, {})])
+    builder.push_metrics([("lat", 6.0, {})])
+    stats = builder.get_stats("lat")
+    assert (stats["min"], stats["max"], stats["avg"], stats["count"]) == (2.0, 6.0, 4.0, 3)
+    assert builder.get_stats("z")["count"] == 1
+
+def test_close_closes_the_connection_when_the_final_flush_fails(monkeypatch, caplog):
+    builder = DashboardBuilder(":memory:", flush_interval=60)
+    builder.push_metric("cpu", 1.0)
+
+    def failing_write(rows):
+        raise sqlite3.OperationalError("disk I/O error")
+
+    monkeypatch.setattr(builder, "_write_rows", failing_write)
+    with pytest.raises(sqlite3.OperationalError):
+        builder.close()
+    with pytest.raises(sqlite3.ProgrammingError):
+        builder._conn.execute("SELECT 1")
+    assert "1 buffered metric points unwritten" in caplog.text
+    builder.close()
+
+def test_unclosed_builder_is_collected(tmp_path):
+    db_path = str(tmp_path / "dash.db")
+    builder = DashboardBuilder(db_path, flush_interval=0.01)
+    builder.push_metric("cpu", 1.0)
+    ref = weakref.ref(builder)
+    flusher = builder._flusher_thread
+    del builder
+    gc.collect()
+    assert ref() is None
+    flusher.join(timeout=1)
+    assert not flusher.is_alive()
+    with DashboardBuilder(db_path) as reopened:
+        assert reopened.get_current_value("cpu") == 1.0
+
+def test_flush_waits_for_in_progress_flush():
+    builder = DashboardBuilder(":memory:", flush_interval=60)
+    builder.push_metric("cpu", 1.0)
+    results = []
+    reader = threading.Thread(target=lambda: results.append(builder.query_metrics("cpu")))
+    # While another flush holds the lock, a reader must wait rather than read early
+    with builder._flush_lock:
+        reader.start()
+        time.sleep(0.05)
+        assert results == []
+    reader.join()
+    assert len(results[0]) == 1
+    builder.close()
+
+def test_label_key_does_not_depend_on_json_backend(tmp_path):
+    db_path = str(tmp_path / "dash.db")
+    with DashboardBuilder(db_path) as builder:
+        builder.push_metric("cpu", 1.0, {"host": "café"})
+    # A file written with \u-escaped labels (older stdlib fallback) is rewritten on open
+    with DashboardBuilder(db_path) as builder:
+        builder._conn.execute("UPDATE metrics SET labels = ?", ('{"host":"caf\\u00e9"}',))
+        builder._conn.execute("UPDATE metric_stats SET labels = ?", ('{"host":"caf\\u00e9"}',))
+        builder._conn.execute("PRAGMA user_version = 1")
+    with DashboardBuilder(db_path) as reopened:
+        assert reopened.get_current_value("cpu", {"host": "café"}) == 1.0
+        assert reopened.get_stats("cpu", {"host": "café"})["count"] == 1
+        reopened.push_metric("cpu", 2.0, {1: "x"})
+        assert reopened.get_current_value("cpu", {"1": "x"}) == 2.0
+
+def test_concurrent_writers_on_one_file_wait_for_the_lock(tmp_path):
+    db_path = str(tmp_path / "dash.db")
+    builders = [DashboardBuilder(db_path) for _ in range(4)]
+    errors = []
+
+    def write(i, builder):
+        for n in range(50):
+            try:
+                builder.push_metrics([(f"w{i}", float(n), {})])
+            except Exception as exc:
+                errors.append(exc)
+
+    threads = [threading.Thread(target=write, args=(i, b)) for i, b in enumerate(builders)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert [builders[0].get_stats(f"w{i}")["count"] for i in range(4)] == [50] * 4
+    for builder in builders:
+        builder.close()
+
+def test_concurrent_first_opens_of_one_file(tmp_path):
+    errors = []
+
+    def open_db(path):
+        try:
+            DashboardBuilder(path).close()
+        except Exception as exc:
+            errors.append(exc)
+
+    for trial in range(5):
+        db_path = str(tmp_path / f"dash{trial}.db")
+        threads = [threading.Thread(target=open_db, args=(db_path,)) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert errors == []